@@ -7,18 +7,28 @@
 #
 # Correr local:
 #   python -m uvicorn api_sw:app --reload
+#   ENV=dev python api_sw.py               (un worker, con reload)
+#
+# En producción corre con varios workers (WEB_CONCURRENCY). Cada worker es
+# un proceso aparte: EPISODE_CACHE y los clientes HTTP/AnimeFLV son por
+# worker, así que cada uno calienta su propia caché (compartirla pediría Redis).
 # ------------------------------------------------------------
 
 import os
 import re
 import html
-import json
-import time
-import requests
-from typing import List, Optional, Literal
+import orjson
+import asyncio
+import threading
+import httpx
+from cachetools import TTLCache
+from typing import Dict, List, Optional, Literal
 
-from fastapi import FastAPI, HTTPException, Query
+from fastapi import FastAPI, HTTPException, Query, Response
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import ORJSONResponse
 from pydantic import BaseModel
 from animeflv import AnimeFLV
 
@@ -37,10 +47,16 @@ UA = os.getenv(
     "(KHTML, like Gecko) Chrome/120 Safari/537.36",
 )
 
+EPISODE_TTL_SEC = int(os.getenv("EPISODE_TTL_SEC", "3600"))
+
 VIDEOS_RE = re.compile(r"var\s+videos\s*=\s*(\{.*?\});", re.DOTALL | re.IGNORECASE)
-ANIMEID_RE = re.compile(r"var\s+anime_id\s*=\s*(\d+)\s*;", re.IGNORECASE)
-EPISODEID_RE = re.compile(r"var\s+episode_id\s*=\s*(\d+)\s*;", re.IGNORECASE)
-EPNUM_RE = re.compile(r"var\s+episode_number\s*=\s*(\d+)\s*;", re.IGNORECASE)
+VIDEOS_ANCHOR_RE = re.compile(r"var\s+videos\s*=\s*", re.IGNORECASE)
+JSON_SCAN_RE = re.compile(r'["\\{}]')
+IDS_RE = re.compile(
+    r"var\s+(?P<name>anime_id|episode_id|episode_number)\s*=\s*(?P<value>\d+)\s*;",
+    re.IGNORECASE,
+)
+ID_KEYS = ("anime_id", "episode_id", "episode_number")
 
 # ------------ Models ------------
 class SeriesItem(BaseModel):
@@ -72,7 +88,8 @@ class VideosResponse(BaseModel):
 app = FastAPI(
     title="Anime API (videos embebidos)",
     version="2.1.0",
-    description="API para buscar series, listar episodios y obtener enlaces de 'var videos' tal como aparecen en AnimeFLV."
+    description="API para buscar series, listar episodios y obtener enlaces de 'var videos' tal como aparecen en AnimeFLV.",
+    default_response_class=ORJSONResponse,
 )
 
 app.add_middleware(
@@ -82,133 +99,253 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(GZipMiddleware, minimum_size=1024)
+
+# ------------ Clientes compartidos ------------
+# Un solo pool para todo el scraping: HTTP/2 + keep-alive evita repetir el handshake TLS.
+HTTP_LIMITS = httpx.Limits(max_connections=100, max_keepalive_connections=20, keepalive_expiry=60)
+HTTP_CLIENT: Optional[httpx.AsyncClient] = None
+PRECONNECT_TASK: Optional[asyncio.Task] = None
+# AnimeFLV abre una sesión cloudscraper por instancia; se reutiliza una sola durante toda la
+# vida del proceso. Esa sesión no es segura entre hilos (requests.Session no lo garantiza y
+# cloudscraper guarda en la instancia el estado del challenge): las llamadas se serializan.
+ANIME_CLIENT: Optional[AnimeFLV] = None
+ANIME_CLIENT_LOCK = threading.Lock()
+
+@app.on_event("startup")
+async def _open_http_client():
+    global HTTP_CLIENT, PRECONNECT_TASK
+    HTTP_CLIENT = httpx.AsyncClient(
+        headers={"User-Agent": UA},
+        timeout=20,
+        follow_redirects=True,  # como requests: los mirrors pueden redirigir
+        # http2/limits van en el transport: httpx los ignora en el cliente si se pasa uno.
+        transport=httpx.AsyncHTTPTransport(http2=True, limits=HTTP_LIMITS, retries=2),
+    )
+    # Precalentar la conexión al mirror principal en segundo plano: el arranque no espera la red.
+    PRECONNECT_TASK = asyncio.create_task(_preconnect(HTTP_CLIENT))
+
+async def _preconnect(client: httpx.AsyncClient):
+    try:
+        await client.head(BASE_CANDIDATES[0], timeout=5)
+    except httpx.HTTPError:
+        pass
+
+@app.on_event("startup")
+async def _open_anime_client():
+    global ANIME_CLIENT
+    ANIME_CLIENT = AnimeFLV()
+
+@app.on_event("shutdown")
+async def _close_http_client():
+    global HTTP_CLIENT, PRECONNECT_TASK
+    if PRECONNECT_TASK is not None:
+        PRECONNECT_TASK.cancel()
+        PRECONNECT_TASK = None
+    if HTTP_CLIENT is not None:
+        await HTTP_CLIENT.aclose()
+        HTTP_CLIENT = None
+
+@app.on_event("shutdown")
+async def _close_anime_client():
+    global ANIME_CLIENT
+    if ANIME_CLIENT is not None:
+        ANIME_CLIENT.close()
+        ANIME_CLIENT = None
 
 # ------------ Helpers ------------
-def with_api():
-    return AnimeFLV()
+def anime_call(fn, *args):
+    # Corre en el threadpool: fn(ANIME_CLIENT, *args) con el lock tomado
+    with ANIME_CLIENT_LOCK:
+        return fn(ANIME_CLIENT, *args)
 
-def retry(fn, tries=3, delay=0.8):
+async def retry(fn, tries=3, delay=0.8):
     last_exc = None
     for _ in range(tries):
         try:
-            return fn()
+            return await fn()
         except Exception as e:
             last_exc = e
-            time.sleep(delay)
+            await asyncio.sleep(delay)
     raise last_exc
 
-def http_get(url, referer=None, timeout=20):
-    headers = {"User-Agent": UA}
-    if referer:
-        headers["Referer"] = referer
-    r = requests.get(url, headers=headers, timeout=timeout)
+async def http_get(url, referer=None):
+    headers = {"Referer": referer} if referer else None
+    r = await HTTP_CLIENT.get(url, headers=headers)
     r.raise_for_status()
     return r
 
-def fetch_episode_html(slug: str, ep_number: int) -> tuple[str, str]:
+async def fetch_episode_html(slug: str, ep_number: int) -> tuple[str, str]:
     last_err = None
     for base in BASE_CANDIDATES:
         url = f"{base}/ver/{slug}-{ep_number}"
         try:
-            html_text = http_get(url).text
+            html_text = (await http_get(url)).text
             return html_text, url
         except Exception as e:
             last_err = e
             continue
     raise RuntimeError(f"No se pudo cargar la página del episodio. Último error: {last_err}")
 
-def extract_videos_dict(page_html: str) -> dict:
+def scan_json_object(text: str, start: int) -> Optional[str]:
+    # Recorre desde text[start] == "{" contando llaves (ignorando las que van
+    # dentro de strings) y corta en cuanto el objeto cierra. Lineal, sin backtracking:
+    # JSON_SCAN_RE salta directo al siguiente carácter relevante.
+    depth = 0
+    in_str = False
+    escaped_at = -1
+    for m in JSON_SCAN_RE.finditer(text, start):
+        i = m.start()
+        if i == escaped_at:
+            continue
+        ch = text[i]
+        if in_str:
+            if ch == "\\":
+                escaped_at = i + 1
+            elif ch == '"':
+                in_str = False
+        elif ch == '"':
+            in_str = True
+        elif ch == "{":
+            depth += 1
+        elif ch == "}":
+            depth -= 1
+            if depth == 0:
+                return text[start:i + 1]
+    return None
+
+def find_videos_json(page_html: str) -> Optional[str]:
+    # find() ubica candidatos sin regex sobre toda la página; el anclaje se confirma con match()
+    # y el objeto tiene que empezar justo después del "=" (descarta videos_backup, = null, ...)
+    pos = page_html.find("var videos")
+    while pos != -1:
+        m = VIDEOS_ANCHOR_RE.match(page_html, pos)
+        if m and page_html.startswith("{", m.end()):
+            raw = scan_json_object(page_html, m.end())
+            if raw is not None:
+                return raw
+            break
+        pos = page_html.find("var videos", pos + 1)
+    # Fallback: objeto sin cerrar o anclaje que no calza
     m = VIDEOS_RE.search(page_html)
-    if not m:
+    return m.group(1) if m else None
+
+def extract_videos_dict(page_html: str) -> dict:
+    raw = find_videos_json(page_html)
+    if raw is None:
         raise RuntimeError("No encontré 'var videos = {...};' en la página.")
-    raw_json = html.unescape(m.group(1))
+    # Un solo replace sobre todo el payload en vez de uno por code/url en flatten_videos
+    raw_json = html.unescape(raw).replace("\\/", "/")
     try:
-        return json.loads(raw_json)
-    except json.JSONDecodeError:
+        return orjson.loads(raw_json)
+    except orjson.JSONDecodeError:
+        # Saltos de línea crudos dentro de strings: JSON inválido para cualquier parser estricto
         cleaned = raw_json.replace("\n", " ").replace("\r", " ")
-        return json.loads(cleaned)
+        return orjson.loads(cleaned)
 
 def extract_ids(page_html: str) -> dict:
-    def _get(rx):
-        m = rx.search(page_html)
-        return m.group(1) if m else None
-    return {
-        "anime_id": _get(ANIMEID_RE),
-        "episode_id": _get(EPISODEID_RE),
-        "episode_number": _get(EPNUM_RE),
-    }
-
-def flatten_videos(videos: dict) -> List[VideoItem]:
+    ids = dict.fromkeys(ID_KEYS)
+    found = 0
+    for m in IDS_RE.finditer(page_html):
+        name = m.group("name").lower()
+        if ids[name] is None:
+            ids[name] = m.group("value")
+            found += 1
+            if found == len(ID_KEYS):
+                break
+    return ids
+
+# (slug, episodio) -> (page_url, videos, ids). Solo se toca desde el event loop.
+EPISODE_CACHE: TTLCache = TTLCache(maxsize=4096, ttl=EPISODE_TTL_SEC)
+
+async def get_episode_data(slug: str, ep_number: int) -> tuple[str, dict, dict]:
+    key = (slug, ep_number)
+    cached = EPISODE_CACHE.get(key)
+    if cached is not None:
+        return cached
+    page_html, page_url = await fetch_episode_html(slug, ep_number)
+    videos = extract_videos_dict(page_html)
+    entry = (page_url, videos, extract_ids(page_html))
+    # Una página sin enlaces puede ser un fallo puntual: no se fija en la caché
+    if videos.get("SUB") or videos.get("LAT"):
+        EPISODE_CACHE[key] = entry
+    return entry
+
+def flatten_videos(videos: dict) -> tuple[List[VideoItem], Dict[str, List[VideoItem]]]:
+    # Devuelve la lista plana y, en la misma pasada, los items agrupados por servidor (para only=)
     out: List[VideoItem] = []
+    by_server: Dict[str, List[VideoItem]] = {}
     for track in ("SUB", "LAT"):
         items = videos.get(track)
         if not isinstance(items, list):
             continue
         for it in items:
-            out.append(VideoItem(
-                track=track,  # type: ignore
+            # Los datos ya vienen con los tipos correctos: model_construct evita validar fila por fila.
+            item = VideoItem.model_construct(
+                track=track,
                 server=(it.get("server") or "").lower(),
                 title=it.get("title"),
-                code=(it.get("code") or "").replace("\\/", "/") or None,
-                url=(it.get("url") or "").replace("\\/", "/") or None,
-            ))
-    return out
+                code=it.get("code") or None,
+                url=it.get("url") or None,
+            )
+            out.append(item)
+            by_server.setdefault(item.server, []).append(item)
+    return out, by_server
 
 PREFERRED = ("sw", "streamwish", "sb", "streamsb", "sbplay", "stape", "okru", "uqload", "mega")
+PREF_INDEX = {name: i for i, name in enumerate(PREFERRED)}
+PREF_MISS = len(PREFERRED) + 10
 
 def pick_best(items: List[VideoItem]) -> Optional[VideoItem]:
-    def pref_index(server: str) -> int:
-        s = (server or "").lower()
-        for i, name in enumerate(PREFERRED):
-            if s == name:
-                return i
-        return len(PREFERRED) + 10
-    items_sorted = sorted(items, key=lambda it: (pref_index(it.server), 0 if it.code else 1))
-    return items_sorted[0] if items_sorted else None
+    # flatten_videos ya normaliza server a minúsculas
+    return min(
+        items,
+        key=lambda it: (PREF_INDEX.get(it.server, PREF_MISS), 0 if it.code else 1),
+        default=None,
+    )
 
 # ------------ Endpoints ------------
 @app.get("/search", response_model=List[SeriesItem])
-def search_series(q: str = Query(..., min_length=1, description="Nombre del anime a buscar")):
+async def search_series(q: str = Query(..., min_length=1, description="Nombre del anime a buscar")):
     try:
-        with with_api() as api:
-            results = retry(lambda: api.search(q)) or []
-            return [
-                SeriesItem(
-                    id=e.id,
-                    title=e.title,
-                    poster=getattr(e, "poster", None),
-                    synopsis=getattr(e, "synopsis", None),
-                )
-                for e in results
-            ]
+        results = await retry(lambda: run_in_threadpool(anime_call, AnimeFLV.search, q)) or []
+        return [
+            SeriesItem(
+                id=e.id,
+                title=e.title,
+                poster=getattr(e, "poster", None),
+                synopsis=getattr(e, "synopsis", None),
+            )
+            for e in results
+        ]
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error al buscar series: {e}")
 
 @app.get("/anime/{anime_id}/episodes", response_model=List[EpisodeItem])
-def get_episodes(anime_id: str):
+async def get_episodes(anime_id: str):
     try:
         if anime_id.isdigit():
             raise HTTPException(
                 status_code=400,
                 detail="anime_id inválido. Debe ser el slug devuelto por /search (ej: 'dragon-ball-daima')."
             )
-        with with_api() as api:
-            info = retry(lambda: api.get_anime_info(anime_id))
-            eps = list(info.episodes or [])
-            eps.sort(key=lambda x: x.id)
-            return [
-                EpisodeItem(id=ep.id, number=ep.id, title=(getattr(ep, "title", None) or f"Episodio {ep.id}"))
-                for ep in eps
-            ]
+        info = await retry(lambda: run_in_threadpool(anime_call, AnimeFLV.get_anime_info, anime_id))
+        eps = list(info.episodes or [])
+        eps.sort(key=lambda x: x.id)
+        return [
+            EpisodeItem(id=ep.id, number=ep.id, title=(getattr(ep, "title", None) or f"Episodio {ep.id}"))
+            for ep in eps
+        ]
     except HTTPException:
         raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error al obtener episodios: {e}")
 
 @app.get("/anime/{anime_id}/episode/{episode_id}/videos", response_model=VideosResponse)
-def get_episode_videos(
+async def get_episode_videos(
     anime_id: str,
     episode_id: int,
+    response: Response,
     only: Optional[str] = Query(None, description="Filtra por servidor (ej: 'sw', 'mega', 'stape')"),
     prefer_best: bool = Query(False, description="Si true, devuelve solo el mejor enlace según prioridad"),
 ):
@@ -218,21 +355,20 @@ def get_episode_videos(
                 status_code=400,
                 detail="anime_id inválido. Debe ser el slug devuelto por /search (ej: 'dragon-ball-daima')."
             )
-        page_html, page_url = fetch_episode_html(anime_id, episode_id)
-        videos = extract_videos_dict(page_html)
-        ids = extract_ids(page_html)
-        items = flatten_videos(videos)
+        page_url, videos, ids = await get_episode_data(anime_id, episode_id)
+        items, by_server = flatten_videos(videos)
         if not items:
             raise HTTPException(status_code=502, detail="No se encontraron enlaces en 'var videos'.")
         if only:
             k = only.strip().lower()
-            items = [it for it in items if it.server == k]
+            items = by_server.get(k, [])
             if not items:
                 raise HTTPException(status_code=404, detail=f"No hay enlaces para el servidor '{only}'.")
         if prefer_best:
             best = pick_best(items)
             if best:
                 items = [best]
+        response.headers["Cache-Control"] = f"public, max-age={EPISODE_TTL_SEC}"
         return VideosResponse(
             page_url=page_url,
             anime_id=ids.get("anime_id"),
@@ -249,4 +385,17 @@ def get_episode_videos(
 if __name__ == "__main__":
     import uvicorn
     port = int(os.getenv("PORT", "8001"))
-    uvicorn.run("api_sw:app", host="0.0.0.0", port=port, reload=True)
+    if os.getenv("ENV") == "dev":
+        uvicorn.run("api_sw:app", host="0.0.0.0", port=port, reload=True)
+    else:
+        uvicorn.run(
+            "api_sw:app",
+            host="0.0.0.0",
+            port=port,
+            loop="uvloop",
+            http="httptools",
+            workers=int(os.getenv("WEB_CONCURRENCY", 2 * (os.cpu_count() or 1))),
+            reload=False,
+            access_log=False,
+            log_level="warning",
+        )